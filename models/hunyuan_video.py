@@ -1,26 +1,29 @@
 from pathlib import Path
+from contextlib import nullcontext
 import sys
 import argparse
 import json
 import os.path
 sys.path.insert(0, os.path.abspath('submodules/HunyuanVideo'))
 
+import peft
 import safetensors
 import torch
 from torch import nn
 import torch.nn.functional as F
+from torch.nn.attention import SDPBackend, sdpa_kernel
 from accelerate import init_empty_weights
 from accelerate.utils import set_module_tensor_to_device
 from loguru import logger
 
 from models.base import BasePipeline, PreprocessMediaFile, make_contiguous
 from utils.common import AUTOCAST_DTYPE, load_safetensors
+from utils import context_parallel
 from hyvideo.config import add_network_args, add_extra_models_args, add_denoise_schedule_args, add_inference_args, sanity_check_args
 from hyvideo.modules import load_model
 from hyvideo.vae import load_vae
 from hyvideo.constants import PRECISION_TO_TYPE, PROMPT_TEMPLATE
 from hyvideo.text_encoder import TextEncoder
-from hyvideo.modules.attenion import get_cu_seqlens
 from hyvideo.modules.posemb_layers import get_nd_rotary_pos_embed
 from hyvideo.diffusion.schedulers import FlowMatchDiscreteScheduler
 from hyvideo.diffusion.pipelines import HunyuanVideoPipeline as OriginalHunyuanVideoPipeline
@@ -30,6 +33,9 @@ from hyvideo.vae.autoencoder_kl_causal_3d import AutoencoderKLCausal3D
 FRAMERATE = 24
 # In diffusion-pipe, we already converted the dtype to an object. But Hunyuan scripts want the string version in a lot of places.
 TYPE_TO_PRECISION = {v: k for k, v in PRECISION_TO_TYPE.items()}
+# Backends for the torch SDPA fallback path (i.e. when the standalone flash-attn package isn't
+# installed). cuDNN is deliberately excluded, see __init__.
+SDPA_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
 
 
 def get_rotary_pos_embed(transformer, video_length, height, width):
@@ -181,6 +187,42 @@ def _convert_state_dict_keys(model_state_dict, loaded_state_dict):
         return loaded_state_dict
 
 
+def _replace_linears_with_te_fp8(module):
+    import transformer_engine.pytorch as te
+
+    def make_te_linear(linear):
+        te_linear = te.Linear(
+            linear.in_features, linear.out_features, bias=(linear.bias is not None), params_dtype=torch.bfloat16
+        )
+        with torch.no_grad():
+            te_linear.weight.copy_(linear.weight)
+            if linear.bias is not None:
+                te_linear.bias.copy_(linear.bias)
+        te_linear.weight.requires_grad_(linear.weight.requires_grad)
+        if linear.bias is not None:
+            te_linear.bias.requires_grad_(linear.bias.requires_grad)
+        return te_linear
+
+    for name, child in module.named_children():
+        if isinstance(child, peft.tuners.tuners_utils.BaseTunerLayer):
+            # LoRA wrapper: only the frozen base layer runs in FP8. The lora_A / lora_B matmuls are
+            # tiny and trained, so they stay in the regular precision.
+            base_layer = child.get_base_layer()
+            if isinstance(base_layer, nn.Linear):
+                child.base_layer = make_te_linear(base_layer)
+        elif isinstance(child, nn.Linear):
+            setattr(module, name, make_te_linear(child))
+        else:
+            _replace_linears_with_te_fp8(child)
+
+
+def _fp8_autocast(fp8_recipe):
+    if fp8_recipe is None:
+        return nullcontext()
+    import transformer_engine.pytorch as te
+    return te.fp8_autocast(enabled=True, fp8_recipe=fp8_recipe)
+
+
 def vae_encode(tensor, vae):
     # tensor values already in range [-1, 1] here
     latents = vae.encode(tensor).latent_dist.sample()
@@ -195,6 +237,18 @@ class HunyuanVideoPipeline(BasePipeline):
     def __init__(self, config):
         self.config = config
         self.model_config = self.config['model']
+        self.fp8_recipe = None
+        self._rope_cache = {}
+        self._noise_buf = None
+        self._h2d_stream = None
+
+        # cuDNN's SDPA graph compilation errors out on the attention shapes this model produces, and it
+        # has no upside here over the flash backend, so keep the SDPA fallback path away from it. TF32
+        # matmuls are a free speedup for the fp32 ops outside the autocast regions.
+        torch.backends.cuda.enable_cudnn_sdp(False)
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision('high')
 
         dtype = self.model_config['dtype']
 
@@ -236,8 +290,11 @@ class HunyuanVideoPipeline(BasePipeline):
                 logger=logger,
                 device='cpu',
             )
-        # Enabled by default in inference scripts, so we should probably train with it.
-        vae.enable_tiling()
+        # Enabled by default in inference scripts, so we should probably train with it. Tiling also caps
+        # the peak activation memory of the highest-resolution conv stages, which is what OOMs on
+        # high-res clips, so only disable this if you know you have the headroom.
+        if self.model_config.get('vae_tiling', True):
+            vae.enable_tiling()
 
         # Text encoder
         prompt_template = (
@@ -319,7 +376,38 @@ class HunyuanVideoPipeline(BasePipeline):
         base_dtype = self.model_config['dtype']
         for name, param in transformer.named_parameters():
             dtype_to_use = base_dtype if any(keyword in name for keyword in params_to_keep) else transformer_dtype
-            set_module_tensor_to_device(transformer, name, device='cpu', dtype=dtype_to_use, value=state_dict[name])
+            value = state_dict[name]
+            if value.dtype == dtype_to_use:
+                # No cast needed, so wrap the loaded tensor directly. The parameter then shares the
+                # mmap-backed storage from torch.load / safe_open instead of being copied through freshly
+                # allocated CPU memory, which roughly halves peak RAM during model load.
+                module_path, _, attr = name.rpartition('.')
+                module = transformer.get_submodule(module_path)
+                module._parameters[attr] = nn.Parameter(value, requires_grad=param.requires_grad)
+            else:
+                set_module_tensor_to_device(transformer, name, device='cpu', dtype=dtype_to_use, value=value)
+
+        if self.model_config.get('fp8', False):
+            if torch.cuda.get_device_capability() < (8, 9):
+                raise RuntimeError('model.fp8 requires a GPU with compute capability 8.9 (Ada / Hopper) or higher')
+            from transformer_engine.common.recipe import DelayedScaling, Format
+            self.fp8_recipe = DelayedScaling(fp8_format=Format.E4M3)
+            if 'adapter' not in self.config:
+                # With an adapter the swap is deferred to configure_adapter: te.Linear is not an
+                # nn.Linear subclass, so swapping first would hide every LoRA target module from PEFT.
+                self._swap_stream_block_linears_to_fp8(transformer)
+
+        if self.model_config.get('compile_blocks', False):
+            # Compile only the stream blocks: they are almost all of the compute, and Inductor fuses the
+            # elementwise glue (modulation scale/shift, residuals, norms) around the attention and MLP.
+            # Module.compile() keeps the module object (and so its attributes and parameter names) intact,
+            # which the pipeline parallelism wrapping relies on. dynamic=True avoids recompiles when the
+            # sequence length changes across training samples. InitialLayer/OutputLayer stay eager; they
+            # run once per step and aren't worth the compile time.
+            for block in transformer.double_blocks:
+                block.compile(mode='default', dynamic=True, fullgraph=False)
+            for block in transformer.single_blocks:
+                block.compile(mode='default', dynamic=True, fullgraph=False)
 
         self.diffusers_pipeline.transformer = transformer
         self.transformer.train()
@@ -328,6 +416,23 @@ class HunyuanVideoPipeline(BasePipeline):
         for name, p in self.transformer.named_parameters():
             p.original_name = name
 
+    def _swap_stream_block_linears_to_fp8(self, transformer):
+        # Only the matmul-heavy linears inside the stream blocks run in FP8. Norms, biases, and the
+        # embedding layers (params_to_keep in load_diffusion_model) stay in higher precision for
+        # numerical stability.
+        for block in transformer.double_blocks:
+            _replace_linears_with_te_fp8(block)
+        for block in transformer.single_blocks:
+            _replace_linears_with_te_fp8(block)
+
+    def configure_adapter(self, adapter_config):
+        peft_config = super().configure_adapter(adapter_config)
+        if self.fp8_recipe is not None:
+            # Deferred from load_diffusion_model. Now that PEFT has injected its wrappers, swap the
+            # frozen base layers underneath them.
+            self._swap_stream_block_linears_to_fp8(self.transformer)
+        return peft_config
+
     def __getattr__(self, name):
         return getattr(self.diffusers_pipeline, name)
 
@@ -358,7 +463,26 @@ class HunyuanVideoPipeline(BasePipeline):
 
     def get_call_vae_fn(self, vae):
         def fn(tensor):
-            return {'latents': vae_encode(tensor.to(vae.device, vae.dtype), vae)}
+            # inference_mode, not just no_grad: we never backprop through caching, and it additionally
+            # skips the autograd view/version-counter bookkeeping on every conv activation.
+            with torch.inference_mode():
+                if tensor.device.type == 'cpu' and vae.device.type == 'cuda':
+                    # Video tensors are large (hundreds of MB), so do the H2D copy from pinned memory on
+                    # a side stream. That lets the PCIe transfer overlap with whatever is still queued on
+                    # the compute stream (e.g. the previous batch's encode) instead of blocking on it.
+                    if self._h2d_stream is None:
+                        self._h2d_stream = torch.cuda.Stream()
+                    tensor = tensor.pin_memory()
+                    with torch.cuda.stream(self._h2d_stream):
+                        tensor = tensor.to(vae.device, vae.dtype, non_blocking=True)
+                    torch.cuda.current_stream().wait_stream(self._h2d_stream)
+                    # The device tensor was allocated on the side stream but is consumed on the current
+                    # stream. Tell the caching allocator, or the block could be handed back to the side
+                    # stream and overwritten by the next H2D copy while the encode is still reading it.
+                    tensor.record_stream(torch.cuda.current_stream())
+                else:
+                    tensor = tensor.to(vae.device, vae.dtype)
+                return {'latents': vae_encode(tensor, vae)}
         return fn
 
     def get_call_text_encoder_fn(self, text_encoder):
@@ -370,9 +494,40 @@ class HunyuanVideoPipeline(BasePipeline):
             raise RuntimeError()
         def fn(caption, is_video):
             # args are lists
-            prompt_embeds, prompt_attention_masks = [], []
-            # need to use a loop because is_video might be different for each one
-            for caption, is_video in zip(caption, is_video):
+            batch_size = len(caption)
+            if all(is_video) or not any(is_video):
+                # The common case: is_video is uniform across the batch, so we can set max_length once and
+                # encode all the captions in a single batched forward pass instead of one per caption.
+                if is_video[0]:
+                    if text_encoder_idx == 1:
+                        text_encoder.max_length = self.max_text_length_video
+                    data_type = 'video'
+                else:
+                    if text_encoder_idx == 1:
+                        text_encoder.max_length = self.max_text_length_image
+                    data_type = 'image'
+                (
+                    prompt_embeds,
+                    negative_prompt_embed,
+                    prompt_attention_masks,
+                    negative_prompt_mask,
+                ) = self.encode_prompt(
+                    caption,
+                    device=next(text_encoder.parameters()).device,
+                    num_videos_per_prompt=1,
+                    do_classifier_free_guidance=False,
+                    text_encoder=text_encoder,
+                    data_type=data_type,
+                )
+                if text_encoder_idx == 1:
+                    return {'prompt_embeds_1': prompt_embeds, 'prompt_attention_mask_1': prompt_attention_masks}
+                elif text_encoder_idx == 2:
+                    return {'prompt_embeds_2': prompt_embeds}
+                else:
+                    raise RuntimeError()
+            prompt_embeds = prompt_attention_masks = None
+            # need to use a loop because is_video is different for each one
+            for i, (caption, is_video) in enumerate(zip(caption, is_video)):
                 if is_video:
                     # This is tricky. The text encoder will crop off the prompt correctly based on the data_type, but the offical code only sets the max
                     # length (which needs to be set accordingly to the prompt) once. So we have to do it here each time.
@@ -396,10 +551,13 @@ class HunyuanVideoPipeline(BasePipeline):
                     text_encoder=text_encoder,
                     data_type=data_type,
                 )
-                prompt_embeds.append(prompt_embed)
-                prompt_attention_masks.append(prompt_mask)
-            prompt_embeds = torch.cat(prompt_embeds)
-            prompt_attention_masks = torch.cat(prompt_attention_masks)
+                # Write each result into a pre-sized output instead of collecting per-caption tensors and
+                # torch.cat-ing at the end, which would copy every embedding a second time.
+                if prompt_embeds is None:
+                    prompt_embeds = torch.empty((batch_size, *prompt_embed.shape[1:]), dtype=prompt_embed.dtype, device=prompt_embed.device)
+                    prompt_attention_masks = torch.empty((batch_size, *prompt_mask.shape[1:]), dtype=prompt_mask.dtype, device=prompt_mask.device)
+                prompt_embeds[i].copy_(prompt_embed[0])
+                prompt_attention_masks[i].copy_(prompt_mask[0])
             if text_encoder_idx == 1:
                 return {'prompt_embeds_1': prompt_embeds, 'prompt_attention_mask_1': prompt_attention_masks}
             elif text_encoder_idx == 2:
@@ -444,19 +602,38 @@ class HunyuanVideoPipeline(BasePipeline):
             t = (t * shift) / (1 + (shift - 1) * t)
 
         x_1 = latents
-        x_0 = torch.randn_like(x_1)
+        # Fill a persistent buffer instead of torch.randn_like. The noise is a full latent-sized tensor,
+        # and allocating + freeing it every step churns the caching allocator. x_0 only feeds the
+        # elementwise math below; nothing keeps a reference to it past this method, so reuse is safe.
+        if self._noise_buf is None or self._noise_buf.shape != x_1.shape or self._noise_buf.dtype != x_1.dtype or self._noise_buf.device != x_1.device:
+            self._noise_buf = torch.empty_like(x_1)
+        x_0 = torch.randn(x_1.shape, out=self._noise_buf)
         t_expanded = t.view(-1, 1, 1, 1, 1)
-        x_t = (1 - t_expanded) * x_1 + t_expanded * x_0
-        target = x_0 - x_1
+        # t comes from sampling, not from anything learned, so there's nothing to autograd-track here
+        # (InitialLayer marks x_t as requiring grad once it enters the pipeline). lerp computes
+        # (1 - t) * x_1 + t * x_0 in a single fused kernel instead of three elementwise passes over the
+        # largest tensors in the pipeline.
+        with torch.no_grad():
+            x_t = torch.lerp(x_1, x_0, t_expanded)
+            target = x_0 - x_1
 
         video_length = (num_frames - 1) * 4 + 1
         video_height = h * 8
         video_width = w * 8
-        freqs_cos, freqs_sin = get_rotary_pos_embed(
-            self.transformer, video_length, video_height, video_width
-        )
-        freqs_cos = freqs_cos.expand(bs, -1, -1)
-        freqs_sin = freqs_sin.expand(bs, -1, -1)
+        # The freqs depend only on the video dims, which are constant within a resolution bucket, so
+        # don't recompute the sin/cos tables for every training step.
+        rope_key = (video_length, video_height, video_width)
+        if rope_key not in self._rope_cache:
+            self._rope_cache[rope_key] = get_rotary_pos_embed(
+                self.transformer, video_length, video_height, video_width
+            )
+        freqs_cos, freqs_sin = self._rope_cache[rope_key]
+        # The freqs are the same for every sample, so a length-1 batch dim (a view) is all that's needed:
+        # split_batch hands batch-dim-1 tensors to every micro-batch as-is, and InitialLayer drops the
+        # batch dim again. Expanding to the full batch size risked a hidden .contiguous() downstream
+        # turning the broadcast view into a real per-sample copy.
+        freqs_cos = freqs_cos.unsqueeze(0)
+        freqs_sin = freqs_sin.unsqueeze(0)
 
         # timestep input to model needs to be in range [0, 1000]
         t = t * 1000
@@ -475,19 +652,26 @@ class HunyuanVideoPipeline(BasePipeline):
 
     def to_layers(self):
         transformer = self.transformer
-        layers = [InitialLayer(transformer)]
+        # Sequence lengths as Python ints, computed once per forward in InitialLayer and shared with the
+        # layers that need them. Reading them off the CUDA tensors with .item() in every block would force
+        # a blocking D2H sync per call, serializing the CPU against the GPU across 40+ blocks.
+        seq_len_ctx = {}
+        layers = [InitialLayer(transformer, seq_len_ctx, single_stage=(self.config['pipeline_stages'] == 1))]
         for block in transformer.double_blocks:
-            layers.append(DoubleBlock(block))
-        layers.append(concatenate_hidden_states)
+            layers.append(DoubleBlock(block, fp8_recipe=self.fp8_recipe))
+        layers.append(ConcatenateHiddenStates(reuse_buffer=(self.config['pipeline_stages'] == 1)))
         for block in transformer.single_blocks:
-            layers.append(SingleBlock(block))
-        layers.append(OutputLayer(transformer))
+            layers.append(SingleBlock(block, seq_len_ctx, fp8_recipe=self.fp8_recipe))
+        layers.append(OutputLayer(transformer, seq_len_ctx))
         return layers
 
 
 class InitialLayer(nn.Module):
-    def __init__(self, transformer):
+    def __init__(self, transformer, seq_len_ctx, single_stage=True):
         super().__init__()
+        self.seq_len_ctx = seq_len_ctx
+        self.single_stage = single_stage
+        self._cu_seqlens_cache = {}
         # Prevent registering the whole Transformer.
         self.transformer = [transformer]
         # Explicitly register these modules.
@@ -501,12 +685,21 @@ class InitialLayer(nn.Module):
 
     @torch.autocast('cuda', dtype=AUTOCAST_DTYPE)
     def forward(self, inputs):
-        for item in inputs:
-            if torch.is_floating_point(item):
-                item.requires_grad_(True)
-
         x, t, text_states, text_mask, text_states_2, freqs_cos, freqs_sin, guidance, target = inputs
 
+        # Something has to require grad here or backward() has no graph to work with. On a single stage
+        # the noisy input is enough, and skipping the rest (notably target, which flows untouched to the
+        # loss) keeps autograd from tracking everything done to it along the way. With multiple stages,
+        # though, Deepspeed calls backward() on *every* floating-point tensor a stage sends downstream
+        # (and only re-marks inputs itself under reentrant activation checkpointing), so the pass-through
+        # floats must require grad too or the first backward raises.
+        if self.single_stage:
+            x.requires_grad_(True)
+        else:
+            for tensor in inputs:
+                if torch.is_floating_point(tensor):
+                    tensor.requires_grad_(True)
+
         _, _, ot, oh, ow = x.shape
         tt, th, tw = (
             ot // self.transformer[0].patch_size[0],
@@ -553,61 +746,161 @@ class InitialLayer(nn.Module):
         img_seq_len = img.shape[1]
 
         # Compute cu_squlens and max_seqlen for flash attention
-        cu_seqlens = get_cu_seqlens(text_mask, img_seq_len)
+        cu_seqlens = self._get_cu_seqlens(text_mask, img_seq_len)
+
+        if context_parallel.is_context_parallel_enabled():
+            cp_size = context_parallel.get_context_parallel_world_size()
+            cp_rank = context_parallel.get_context_parallel_rank()
+            if img_seq_len % cp_size != 0 or txt_seq_len % cp_size != 0:
+                raise RuntimeError(
+                    f'context_parallel_size={cp_size} must evenly divide img_seq_len={img_seq_len} and txt_seq_len={txt_seq_len}'
+                )
+            # Shard the sequence dim across the CP group. Per-token modules run on the shard as-is; the
+            # patched attention does the all-to-alls so every query still attends over the full sequence.
+            # The rotary freqs only cover the img tokens, so they're sharded the same way img is.
+            img = img.chunk(cp_size, dim=1)[cp_rank]
+            txt = txt.chunk(cp_size, dim=1)[cp_rank]
+            freqs_cos = freqs_cos.chunk(cp_size, dim=0)[cp_rank]
+            freqs_sin = freqs_sin.chunk(cp_size, dim=0)[cp_rank]
+            txt_seq_len = txt.shape[1]
+            img_seq_len = img.shape[1]
+
+        self.seq_len_ctx['txt_seq_len'] = txt_seq_len
+        self.seq_len_ctx['img_seq_len'] = img_seq_len
 
         # Everything passed between layers needs to be a CUDA tensor for Deepspeed pipeline parallelism.
         txt_seq_len = torch.tensor(txt_seq_len, device=img.device)
         img_seq_len = torch.tensor(img_seq_len, device=img.device)
         max_seqlen = img_seq_len + txt_seq_len
+        # Mark which threaded tensor the cached ints belong to. Downstream layers check object identity
+        # against this token: it's a fresh object every micro-batch (Deepspeed clones received tensors)
+        # and stable within a stage's forward, so it says "current micro-batch" without a sync. Matching
+        # on shapes instead would go stale when consecutive batches have different txt/img splits with
+        # the same total length.
+        self.seq_len_ctx['token'] = txt_seq_len
 
         return make_contiguous(img, txt, vec, cu_seqlens, max_seqlen, freqs_cos, freqs_sin, txt_seq_len, img_seq_len, unpatchify_args, target)
 
+    def _get_cu_seqlens(self, text_mask, img_seq_len):
+        # Replacement for hyvideo's get_cu_seqlens, which fills the tensor with a Python loop of
+        # 2*batch_size single-element CUDA assignments (a kernel launch each) every step. Only the odd
+        # entries depend on the per-sample text lengths; everything else is shape-dependent, so cache it
+        # and fill the odd entries with a couple of vectorized ops. Caching the whole result by mask
+        # contents instead would mean reading the mask back to the host, reintroducing the per-step sync
+        # we just got rid of.
+        batch_size, text_len_max = text_mask.shape
+        max_len = text_len_max + img_seq_len
+        # img_seq_len has to be part of the key: different (text_len_max, img_seq_len) splits can sum to
+        # the same max_len (mixed image/video datasets), and odd_base depends on the split.
+        key = (batch_size, max_len, img_seq_len, text_mask.device)
+        if key not in self._cu_seqlens_cache:
+            # cu_seqlens[2i+2] = (i+1) * max_len; cu_seqlens[2i+1] = i * max_len + img_seq_len + text_len[i]
+            steps = torch.arange(1, batch_size + 1, dtype=torch.int32, device=text_mask.device) * max_len
+            template = torch.zeros(2 * batch_size + 1, dtype=torch.int32, device=text_mask.device)
+            template[2::2] = steps
+            odd_base = steps - max_len + img_seq_len
+            self._cu_seqlens_cache[key] = (template, odd_base)
+        template, odd_base = self._cu_seqlens_cache[key]
+        cu_seqlens = template.clone()
+        cu_seqlens[1::2] = odd_base + text_mask.sum(dim=1, dtype=torch.int32)
+        return cu_seqlens
+
 
 class DoubleBlock(nn.Module):
-    def __init__(self, block):
+    def __init__(self, block, fp8_recipe=None):
         super().__init__()
         self.block = block
+        self.fp8_recipe = fp8_recipe
 
     @torch.autocast('cuda', dtype=AUTOCAST_DTYPE)
     def forward(self, inputs):
         img, txt, vec, cu_seqlens, max_seqlen, freqs_cos, freqs_sin, txt_seq_len, img_seq_len, unpatchify_args, target = inputs
-        img, txt = self.block(img, txt, vec, cu_seqlens, cu_seqlens, max_seqlen.item(), max_seqlen.item(), (freqs_cos, freqs_sin))
+        # max_seqlen is threaded through as a CUDA tensor for Deepspeed pipeline parallelism, but reading it
+        # back with .item() would sync once per block. The value is just the total sequence length, which we
+        # already know from the shapes.
+        max_seqlen_int = img.shape[1] + txt.shape[1]
+        with _fp8_autocast(self.fp8_recipe), sdpa_kernel(SDPA_BACKENDS):
+            img, txt = self.block(img, txt, vec, cu_seqlens, cu_seqlens, max_seqlen_int, max_seqlen_int, (freqs_cos, freqs_sin))
         return make_contiguous(img, txt, vec, cu_seqlens, max_seqlen, freqs_cos, freqs_sin, txt_seq_len, img_seq_len, unpatchify_args, target)
 
 
-def concatenate_hidden_states(inputs):
-    img, txt, vec, cu_seqlens, max_seqlen, freqs_cos, freqs_sin, txt_seq_len, img_seq_len, unpatchify_args, target = inputs
-    x = torch.cat((img, txt), 1)
-    return x, vec, cu_seqlens, max_seqlen, freqs_cos, freqs_sin, txt_seq_len, img_seq_len, unpatchify_args, target
+class ConcatenateHiddenStates:
+    # torch.cat((img, txt), 1) allocates a fresh (B, img_seq+txt_seq, D) tensor every micro-batch. When we
+    # can, write into a persistent buffer instead, so the caching allocator isn't churning through the
+    # largest activation in the pipeline every step. Reuse is only safe when micro-batches run strictly
+    # forward-then-backward, i.e. a single pipeline stage; with multiple stages several micro-batches are
+    # in flight at once and each needs its own storage, so we fall back to a plain cat.
+    def __init__(self, reuse_buffer):
+        self.reuse_buffer = reuse_buffer
+        self.buffer = None
+
+    def __call__(self, inputs):
+        img, txt, vec, cu_seqlens, max_seqlen, freqs_cos, freqs_sin, txt_seq_len, img_seq_len, unpatchify_args, target = inputs
+        if not self.reuse_buffer:
+            x = torch.cat((img, txt), 1)
+        else:
+            shape = (img.shape[0], img.shape[1] + txt.shape[1], img.shape[2])
+            if self.buffer is None or self.buffer.shape != shape or self.buffer.dtype != img.dtype or self.buffer.device != img.device:
+                self.buffer = torch.empty(shape, dtype=img.dtype, device=img.device)
+            # detach() so each micro-batch starts from a history-free alias of the buffer; the copy_ calls
+            # below are still recorded by autograd and route gradients back to img and txt.
+            x = self.buffer.detach()
+            x[:, :img.shape[1]].copy_(img)
+            x[:, img.shape[1]:].copy_(txt)
+        return x, vec, cu_seqlens, max_seqlen, freqs_cos, freqs_sin, txt_seq_len, img_seq_len, unpatchify_args, target
 
 
 class SingleBlock(nn.Module):
-    def __init__(self, block):
+    def __init__(self, block, seq_len_ctx, fp8_recipe=None):
         super().__init__()
         self.block = block
+        self.seq_len_ctx = seq_len_ctx
+        self.fp8_recipe = fp8_recipe
 
     @torch.autocast('cuda', dtype=AUTOCAST_DTYPE)
     def forward(self, inputs):
         x, vec, cu_seqlens, max_seqlen, freqs_cos, freqs_sin, txt_seq_len, img_seq_len, unpatchify_args, target = inputs
-        x = self.block(x, vec, txt_seq_len.item(), cu_seqlens, cu_seqlens, max_seqlen.item(), max_seqlen.item(), (freqs_cos, freqs_sin))
+        # x is the concatenated img+txt sequence, so its length is max_seqlen. The txt length isn't
+        # derivable from shapes here; the shared context holds it when an earlier layer on this stage
+        # already resolved it for this micro-batch (checked by token identity — a shape match isn't
+        # enough, since different txt/img splits can sum to the same length). Otherwise sync once and
+        # cache it for the rest of the blocks on this stage.
+        max_seqlen_int = x.shape[1]
+        if self.seq_len_ctx.get('token') is not txt_seq_len:
+            self.seq_len_ctx['txt_seq_len'] = txt_seq_len.item()
+            self.seq_len_ctx['img_seq_len'] = max_seqlen_int - self.seq_len_ctx['txt_seq_len']
+            self.seq_len_ctx['token'] = txt_seq_len
+        txt_seq_len_int = self.seq_len_ctx['txt_seq_len']
+        with _fp8_autocast(self.fp8_recipe), sdpa_kernel(SDPA_BACKENDS):
+            x = self.block(x, vec, txt_seq_len_int, cu_seqlens, cu_seqlens, max_seqlen_int, max_seqlen_int, (freqs_cos, freqs_sin))
         return make_contiguous(x, vec, cu_seqlens, max_seqlen, freqs_cos, freqs_sin, txt_seq_len, img_seq_len, unpatchify_args, target)
 
 class OutputLayer(nn.Module):
-    def __init__(self, transformer):
+    def __init__(self, transformer, seq_len_ctx):
         super().__init__()
         # Prevent registering the whole Transformer.
         self.transformer = [transformer]
+        self.seq_len_ctx = seq_len_ctx
         # Explicitly register these modules.
         self.final_layer = self.transformer[0].final_layer
 
     @torch.autocast('cuda', dtype=AUTOCAST_DTYPE)
     def forward(self, inputs):
         x, vec, cu_seqlens, max_seqlen, freqs_cos, freqs_sin, txt_seq_len, img_seq_len, unpatchify_args, target = inputs
-        img = x[:, :img_seq_len.item(), ...]
+        if self.seq_len_ctx.get('token') is txt_seq_len:
+            img_seq_len_int = self.seq_len_ctx['img_seq_len']
+        else:
+            img_seq_len_int = img_seq_len.item()
+        img = x[:, :img_seq_len_int, ...]
 
         # ---------------------------- Final layer ------------------------------
         img = self.final_layer(img, vec)  # (N, T, patch_size ** 2 * out_channels)
 
+        if context_parallel.is_context_parallel_enabled():
+            # Reassemble the full sequence before unpatchify. The shards were contiguous rank-major
+            # chunks, so the all-gather restores the original token order.
+            img = context_parallel.gather_sequence(img, dim=1)
+
         tt, th, tw = (arg.item() for arg in unpatchify_args)
         output = self.transformer[0].unpatchify(img, tt, th, tw)
 
@@ -615,4 +908,12 @@ class OutputLayer(nn.Module):
             output = output.to(torch.float32)
             target = target.to(torch.float32)
             loss = F.mse_loss(output, target)
+        if context_parallel.is_context_parallel_enabled():
+            # Every CP rank computes the full loss but only its sequence shard's share of the parameter
+            # gradients (gather_sequence's backward hands back the local chunk), so the true gradient is
+            # the *sum* over the CP group. Deepspeed treats CP ranks as ordinary data-parallel ranks and
+            # averages over the whole world instead, which would shrink the gradients by cp_size. Scale
+            # only the backward pass to cancel that; the loss value itself is left alone so logging and
+            # eval are unaffected.
+            loss = context_parallel.scale_grad(loss, context_parallel.get_context_parallel_world_size())
         return loss
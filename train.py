@@ -21,6 +21,7 @@ import numpy as np
 
 from utils import dataset as dataset_util
 from utils import common
+from utils import context_parallel
 from utils.common import is_main_process, get_rank, DTYPE_MAP
 import utils.saver
 from utils.isolate_rng import isolate_rng
@@ -53,11 +54,38 @@ def _count_all_layer_params(self):
 ds_pipe_module.PipelineModule._count_layer_params = _count_all_layer_params
 
 
+def get_selective_checkpoint_func():
+    # Selective activation checkpointing: recompute the cheap elementwise and MLP ops during backward,
+    # but keep the attention outputs. Flash attention's backward already recomputes the softmax
+    # internally, so replaying the whole attention op during checkpoint recomputation pays the most
+    # expensive kernels twice for very little extra memory savings.
+    from torch.utils.checkpoint import CheckpointPolicy, checkpoint, create_selective_checkpoint_contexts
+
+    save_ops = []
+    for op_name in ('_scaled_dot_product_flash_attention', '_scaled_dot_product_efficient_attention', '_scaled_dot_product_cudnn_attention'):
+        if hasattr(torch.ops.aten, op_name):
+            save_ops.append(getattr(torch.ops.aten, op_name).default)
+    try:
+        # Newer flash-attn releases register their kernels as custom ops; save those too if present.
+        save_ops.append(torch.ops.flash_attn._flash_attn_varlen_forward.default)
+    except (AttributeError, RuntimeError):
+        pass
+
+    def policy_fn(ctx, op, *args, **kwargs):
+        return CheckpointPolicy.MUST_SAVE if op in save_ops else CheckpointPolicy.PREFER_RECOMPUTE
+
+    def checkpoint_func(function, *args):
+        return checkpoint(function, *args, use_reentrant=False, context_fn=lambda: create_selective_checkpoint_contexts(policy_fn))
+
+    return checkpoint_func
+
+
 def set_config_defaults(config):
     # Force the user to set this. If we made it a default of 1, it might use a lot of disk space.
     assert 'save_every_n_epochs' in config
 
     config.setdefault('pipeline_stages', 1)
+    config.setdefault('context_parallel_size', 1)
     config.setdefault('activation_checkpointing', False)
     config.setdefault('warmup_steps', 0)
     if 'save_dtype' in config:
@@ -166,7 +194,8 @@ def evaluate(model_engine, eval_dataloaders, tb_writer, step, eval_gradient_accu
     if len(eval_dataloaders) == 0:
         return
     with torch.no_grad(), isolate_rng():
-        seed = get_rank()
+        # Ranks in a context parallel group must sample identical eval noise (world size is 1 without CP).
+        seed = get_rank() // context_parallel.get_context_parallel_world_size()
         random.seed(seed)
         torch.manual_seed(seed)
         np.random.seed(seed)
@@ -201,6 +230,17 @@ if __name__ == '__main__':
 
     model_type = config['model']['type']
 
+    if (cp_size := config['context_parallel_size']) > 1:
+        if model_type != 'hunyuan-video':
+            raise NotImplementedError('context_parallel_size > 1 is only implemented for hunyuan-video')
+        if config['pipeline_stages'] != 1:
+            raise NotImplementedError('context parallelism cannot be combined with pipeline parallelism')
+        context_parallel.init_context_parallel(cp_size)
+        # Ranks in a CP group shard the same sequences, so everything drawn from the torch RNG in
+        # prepare_inputs (timesteps, noise) must be identical within the group. Seed per CP group; the
+        # ranks run the same code on the same data afterward, so the generators stay in lockstep.
+        torch.manual_seed(12345 + dist.get_rank() // cp_size)
+
     if model_type == 'flux':
         from models import flux
         model = flux.FluxPipeline(config)
@@ -274,7 +314,10 @@ if __name__ == '__main__':
     layers = model.to_layers()
     additional_pipeline_module_kwargs = {}
     if config['activation_checkpointing']:
-        checkpoint_func = deepspeed.checkpointing.checkpoint
+        if config['activation_checkpointing'] == 'selective':
+            checkpoint_func = get_selective_checkpoint_func()
+        else:
+            checkpoint_func = deepspeed.checkpointing.checkpoint
         additional_pipeline_module_kwargs.update({
             'activation_checkpoint_interval': 1,
             'checkpointable_layers': model.checkpointable_layers,
@@ -388,16 +431,20 @@ if __name__ == '__main__':
         lr_scheduler = torch.optim.lr_scheduler.SequentialLR(optimizer, schedulers=[warmup_scheduler, lr_scheduler], milestones=[warmup_steps])
     model_engine.lr_scheduler = lr_scheduler
 
+    # Deepspeed doesn't know about context parallelism and sees every rank as a data parallel rank. All
+    # ranks in a CP group must see identical data, so a CP group acts as a single rank to the dataloaders.
+    dataloader_rank = model_engine.grid.get_data_parallel_rank() // cp_size
+    dataloader_world_size = model_engine.grid.get_data_parallel_world_size() // cp_size
     train_data.post_init(
-        model_engine.grid.get_data_parallel_rank(),
-        model_engine.grid.get_data_parallel_world_size(),
+        dataloader_rank,
+        dataloader_world_size,
         model_engine.train_micro_batch_size_per_gpu(),
         model_engine.gradient_accumulation_steps(),
     )
     for eval_data in eval_data_map.values():
         eval_data.post_init(
-            model_engine.grid.get_data_parallel_rank(),
-            model_engine.grid.get_data_parallel_world_size(),
+            dataloader_rank,
+            dataloader_world_size,
             config.get('eval_micro_batch_size_per_gpu', model_engine.train_micro_batch_size_per_gpu()),
             config['eval_gradient_accumulation_steps'],
         )
@@ -0,0 +1,116 @@
+import torch
+import torch.distributed as dist
+
+# Ulysses-style context parallelism (Deepspeed-Ulysses). The sequence dimension is sharded across the
+# ranks of a context parallel (CP) group. All per-token modules (linears, norms, MLPs) run unchanged on
+# the local shard. At attention time, an all-to-all regroups QKV from (batch, seq/P, heads, dim) to
+# (batch, seq, heads/P, dim), each rank attends over the full sequence with its subset of heads, and a
+# second all-to-all moves the output back to the sequence-sharded layout. Communication is O(seq*dim)
+# while attention compute is O(seq^2*dim), so this scales well exactly when sequences are long.
+
+_CP_GROUP = None
+
+
+def init_context_parallel(cp_size):
+    # Consecutive ranks form a CP group. new_group() must be called by every rank for every group.
+    global _CP_GROUP
+    if cp_size <= 1:
+        return
+    world_size = dist.get_world_size()
+    if world_size % cp_size != 0:
+        raise RuntimeError(f'world size {world_size} is not divisible by context_parallel_size {cp_size}')
+    rank = dist.get_rank()
+    for start in range(0, world_size, cp_size):
+        ranks = list(range(start, start + cp_size))
+        group = dist.new_group(ranks)
+        if rank in ranks:
+            _CP_GROUP = group
+
+
+def is_context_parallel_enabled():
+    return _CP_GROUP is not None
+
+
+def get_context_parallel_group():
+    return _CP_GROUP
+
+
+def get_context_parallel_world_size():
+    return dist.get_world_size(_CP_GROUP) if _CP_GROUP is not None else 1
+
+
+def get_context_parallel_rank():
+    return dist.get_rank(_CP_GROUP) if _CP_GROUP is not None else 0
+
+
+def _all_to_all(x, scatter_dim, gather_dim):
+    world_size = get_context_parallel_world_size()
+    inputs = [t.contiguous() for t in x.chunk(world_size, dim=scatter_dim)]
+    outputs = [torch.empty_like(t) for t in inputs]
+    dist.all_to_all(outputs, inputs, group=_CP_GROUP)
+    return torch.cat(outputs, dim=gather_dim)
+
+
+class _AllToAll(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, scatter_dim, gather_dim):
+        ctx.scatter_dim = scatter_dim
+        ctx.gather_dim = gather_dim
+        return _all_to_all(x, scatter_dim, gather_dim)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        # The backward of an all-to-all is the same all-to-all with the dims swapped.
+        return _all_to_all(grad_output, ctx.gather_dim, ctx.scatter_dim), None, None
+
+
+def all_to_all_scatter_heads(x):
+    # (batch, seq/P, heads, head_dim) -> (batch, seq, heads/P, head_dim). The gathered sequence is the
+    # rank-major concatenation of the shards.
+    if x.shape[2] % get_context_parallel_world_size() != 0:
+        raise RuntimeError(
+            f'number of attention heads {x.shape[2]} is not divisible by context_parallel_size {get_context_parallel_world_size()}'
+        )
+    return _AllToAll.apply(x, 2, 1)
+
+
+def all_to_all_gather_heads(x):
+    # (batch, seq, heads/P, head_dim) -> (batch, seq/P, heads, head_dim)
+    return _AllToAll.apply(x, 1, 2)
+
+
+class _GatherSequence(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, dim):
+        ctx.dim = dim
+        x = x.contiguous()
+        tensors = [torch.empty_like(x) for _ in range(get_context_parallel_world_size())]
+        dist.all_gather(tensors, x, group=_CP_GROUP)
+        return torch.cat(tensors, dim=dim)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        chunk = grad_output.chunk(get_context_parallel_world_size(), dim=ctx.dim)[get_context_parallel_rank()]
+        return chunk.contiguous(), None
+
+
+def gather_sequence(x, dim=1):
+    # All-gather the sequence shards so every rank has the full sequence. Backward takes the local slice
+    # of the incoming gradient.
+    return _GatherSequence.apply(x, dim)
+
+
+class _ScaleGrad(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, scale):
+        ctx.scale = scale
+        return x
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output * ctx.scale, None
+
+
+def scale_grad(x, scale):
+    # Identity in forward, multiplies the gradient by scale in backward.
+    return _ScaleGrad.apply(x, scale)
@@ -649,7 +649,13 @@ class DatasetManager:
 def split_batch(batch, pieces):
     example_tuple = batch
     split_size = example_tuple[0].size(0) // pieces
-    split_examples = zip(*(torch.split(tensor, split_size) for tensor in example_tuple))
+    # Tensors with a batch dim of 1 are per-batch-constant (e.g. rotary freqs): hand the same view to
+    # every micro-batch instead of splitting, so prepare_inputs doesn't have to expand them to the full
+    # batch size.
+    split_examples = zip(*(
+        [tensor] * pieces if (pieces > 1 and tensor.size(0) == 1) else torch.split(tensor, split_size)
+        for tensor in example_tuple
+    ))
     # Deepspeed works with a tuple of (features, labels), even if we don't provide a loss_fn to PipelineEngine,
     # and instead compute the loss ourselves in the model. It's okay to just return None for the labels here.
     return [(ex, None) for ex in split_examples]
@@ -0,0 +1,60 @@
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+
+if triton is not None:
+    @triton.jit
+    def _fused_modulate_kernel(X, SCALE, SHIFT, Y, seq_len, N, BLOCK_N: tl.constexpr):
+        # One program per (batch, seq) row. scale/shift are per-batch modulation vectors broadcast over
+        # the sequence dim.
+        row = tl.program_id(0)
+        batch = row // seq_len
+        cols = tl.arange(0, BLOCK_N)
+        mask = cols < N
+        x = tl.load(X + row * N + cols, mask=mask, other=0.0)
+        scale = tl.load(SCALE + batch * N + cols, mask=mask, other=0.0)
+        shift = tl.load(SHIFT + batch * N + cols, mask=mask, other=0.0)
+        y = x * (1 + scale) + shift
+        tl.store(Y + row * N + cols, y, mask=mask)
+
+
+class _FusedModulate(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, shift, scale):
+        x = x.contiguous()
+        shift = shift.contiguous()
+        scale = scale.contiguous()
+        batch, seq_len, n = x.shape
+        y = torch.empty_like(x)
+        _fused_modulate_kernel[(batch * seq_len,)](x, scale, shift, y, seq_len, n, BLOCK_N=triton.next_power_of_2(n))
+        ctx.save_for_backward(x, scale)
+        return y
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, scale = ctx.saved_tensors
+        grad_x = grad_output * (1 + scale.unsqueeze(1))
+        grad_shift = grad_output.sum(dim=1)
+        grad_scale = (grad_output * x).sum(dim=1)
+        return grad_x, grad_shift, grad_scale
+
+
+def fused_modulate(x, shift=None, scale=None):
+    # Drop-in replacement for hyvideo's modulate helper. x * (1 + scale) + shift is memory-bandwidth
+    # bound, and eager mode launches three kernels for it, reading x three times. The Triton kernel reads
+    # x once and writes once.
+    if triton is None or not x.is_cuda or shift is None or scale is None or x.ndim != 3:
+        if scale is None and shift is None:
+            return x
+        elif shift is None:
+            return x * (1 + scale.unsqueeze(1))
+        elif scale is None:
+            return x + shift.unsqueeze(1)
+        else:
+            return x * (1 + scale.unsqueeze(1)) + shift.unsqueeze(1)
+    return _FusedModulate.apply(x, shift.to(x.dtype), scale.to(x.dtype))
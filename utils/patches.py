@@ -10,8 +10,14 @@ from peft.tuners._buffer_dict import BufferDict
 from transformers import CLIPTextModel, AutoModel
 
 import hyvideo.text_encoder
+import hyvideo.modules.attenion
+import hyvideo.modules.models
+import hyvideo.modules.modulate_layers
 from hyvideo.constants import PRECISION_TO_TYPE, TEXT_ENCODER_PATH
 
+from utils import context_parallel
+from utils.fused_modulation import fused_modulate
+
 
 def _move_adapter_to_device_of_base_layer(self, adapter_name: str, device: Optional[torch.device] = None) -> None:
     """
@@ -92,6 +98,95 @@ def load_text_encoder(
     return text_encoder, text_encoder_path
 
 
+_original_attention = None
+_flash_attn_varlen_func = None
+_flash_attn_checked = False
+
+
+def _get_flash_attn_varlen_func():
+    # FA3 (the flash_attn_interface package built from flash-attention/hopper) only supports sm_90.
+    # Everywhere else, use the regular flash-attn v2 package.
+    global _flash_attn_varlen_func, _flash_attn_checked
+    if _flash_attn_checked:
+        return _flash_attn_varlen_func
+    _flash_attn_checked = True
+    if torch.cuda.is_available() and torch.cuda.get_device_capability() == (9, 0):
+        try:
+            from flash_attn_interface import flash_attn_varlen_func
+            _flash_attn_varlen_func = flash_attn_varlen_func
+            return _flash_attn_varlen_func
+        except ImportError:
+            pass
+    try:
+        from flash_attn import flash_attn_varlen_func
+        _flash_attn_varlen_func = flash_attn_varlen_func
+    except ImportError:
+        _flash_attn_varlen_func = None
+    return _flash_attn_varlen_func
+
+
+def _context_parallel_attention(q, k, v, flash_attn_varlen_func):
+    # Ulysses: regroup (batch, seq/P, heads, head_dim) -> (batch, seq, heads/P, head_dim), attend over
+    # the full sequence with the local subset of heads, then regroup back. The gathered sequence is a
+    # fixed permutation of the original (rank-major shards), which attention is invariant to since every
+    # query still sees every key. Per-sample varlen masking isn't representable in the permuted layout,
+    # so text padding tokens participate in attention, same as the torch SDPA fallback.
+    q = context_parallel.all_to_all_scatter_heads(q)
+    k = context_parallel.all_to_all_scatter_heads(k)
+    v = context_parallel.all_to_all_scatter_heads(v)
+    batch_size, seqlen = q.shape[0], q.shape[1]
+    cu_seqlens = torch.arange(0, (batch_size + 1) * seqlen, seqlen, dtype=torch.int32, device=q.device)
+    x = flash_attn_varlen_func(
+        q.reshape(batch_size * seqlen, *q.shape[2:]),
+        k.reshape(batch_size * seqlen, *k.shape[2:]),
+        v.reshape(batch_size * seqlen, *v.shape[2:]),
+        cu_seqlens, cu_seqlens, seqlen, seqlen,
+    )
+    if isinstance(x, tuple):
+        x = x[0]
+    x = x.view(batch_size, seqlen, x.shape[-2], x.shape[-1])
+    x = context_parallel.all_to_all_gather_heads(x)
+    return x.reshape(batch_size, x.shape[1], -1)
+
+
+def attention(
+    q,
+    k,
+    v,
+    mode='flash',
+    drop_rate=0,
+    attn_mask=None,
+    causal=False,
+    cu_seqlens_q=None,
+    cu_seqlens_kv=None,
+    max_seqlen_q=None,
+    max_seqlen_kv=None,
+    batch_size=1,
+):
+    flash_attn_varlen_func = _get_flash_attn_varlen_func() if mode == 'flash' else None
+    if context_parallel.is_context_parallel_enabled():
+        if flash_attn_varlen_func is None:
+            raise RuntimeError('context parallelism requires flash-attn to be installed')
+        return _context_parallel_attention(q, k, v, flash_attn_varlen_func)
+    if flash_attn_varlen_func is None or cu_seqlens_q is None or drop_rate != 0 or causal:
+        # No flash-attn build available, or arguments the varlen API doesn't cover. Let the original
+        # implementation handle it (it falls back to torch SDPA when flash-attn isn't importable).
+        return _original_attention(
+            q, k, v, mode=mode, drop_rate=drop_rate, attn_mask=attn_mask, causal=causal,
+            cu_seqlens_q=cu_seqlens_q, cu_seqlens_kv=cu_seqlens_kv,
+            max_seqlen_q=max_seqlen_q, max_seqlen_kv=max_seqlen_kv, batch_size=batch_size,
+        )
+    # (batch, seq, heads, head_dim) -> (total_tokens, heads, head_dim), the varlen layout
+    q = q.view(q.shape[0] * q.shape[1], *q.shape[2:])
+    k = k.view(k.shape[0] * k.shape[1], *k.shape[2:])
+    v = v.view(v.shape[0] * v.shape[1], *v.shape[2:])
+    x = flash_attn_varlen_func(q, k, v, cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv)
+    if isinstance(x, tuple):
+        # FA3 also returns the softmax lse.
+        x = x[0]
+    return x.view(batch_size, max_seqlen_q, -1)
+
+
 def apply_patches():
     # Prevent PEFT from downcasting LoRA weights to fp8 only for this script to upcast them again.
     # TODO: probably should send a PR to PEFT. Default behavior looks like a mistake to me.
@@ -99,3 +194,19 @@ def apply_patches():
 
     # Use torch_dtype to avoid needlessly loading the text encoder in float32, only to cast it right after.
     hyvideo.text_encoder.load_text_encoder = load_text_encoder
+
+    # The attention in the double / single stream blocks is by far the hottest compute path, and the hyvideo
+    # implementation quietly degrades to torch SDPA (materializing giant attention tensors) if it doesn't like
+    # the flash-attn install. Call flash_attn_varlen_func ourselves, honoring the cu_seqlens the model already
+    # computes, and prefer the FA3 kernels on Hopper.
+    global _original_attention
+    _original_attention = hyvideo.modules.attenion.attention
+    hyvideo.modules.attenion.attention = attention
+    # models.py imports attention by name, so patch its reference too.
+    hyvideo.modules.models.attention = attention
+
+    # The modulation applied after every norm in the stream blocks runs many times per step with tiny
+    # arithmetic intensity. Replace it with a single fused Triton kernel (falls back to the eager version
+    # off-GPU or when triton isn't available).
+    hyvideo.modules.modulate_layers.modulate = fused_modulate
+    hyvideo.modules.models.modulate = fused_modulate